@@ -1,46 +1,137 @@
 import sys
+import argparse
+import re
+import bisect
+import hashlib
+import os
+import tempfile
+from array import array
+
+import isa
 
 # Enable debugging output if needed.
 DEBUG = False
 
-# Lists to hold input lines, error messages, and generated machine code.
-inputline = []
+# List to hold error messages.
 err = []
-mc = []
-
-# Mapping of assembly opcodes to their corresponding binary codes.
-opcodes = {
-    "add": "00000", "sub": "00001", "mul": "00010", "div": "00011",
-    "mod": "00100", "cmp": "00101", "and": "00110", "or": "00111",
-    "not": "01000", "mov": "01001",
-    "lsl": "01010", "lsr": "01011", "asr": "01100", "nop": "01101",
-    "ld": "01110", "st": "01111", "beq": "10000", "bgt": "10001",
-    "b": "10010", "call": "10011", "ret": "10100", "hlt": "11111"
-}
 
-            # Mapping of register names to their binary codes.
-reg = {
-    "r1": "0001", "r2": "0010", "r3": "0011", "r4": "0100",
-    "r5": "0101", "r6": "0110", "r7": "0111", "r8": "1000",
-    "r9": "1001", "r10": "1010", "r11": "1011", "r12": "1100",
-    "r13": "1101", "r14": "1110", "r0": "0000"
-}
+# Instruction set tables, compiled once from the declarative description in isa.py.
+ISA = isa.load()
+opcodes = ISA["opcodes"]         # Mnemonic -> opcode bits.
+reg = ISA["reg"]                 # Register name -> register bits.
+instrType = ISA["instrType"]     # Mnemonic (with u/h variants) -> instruction type.
+mnemonic = ISA["mnemonic"]       # Mnemonic -> (base, opcode, type, modifier).
+regNum = ISA["regNum"]
+decode = ISA["decode"]           # Opcode -> (base mnemonic, type).
+fields = ISA["fields"]           # Bit field -> (lowest bit, width).
+fieldMask = ISA["mask"]          # Bit field -> mask of its width.
+layout = ISA["layout"]           # Type -> (register form fields, immediate form fields).
+wordMask = ISA["wordMask"]
 
-        # Mapping of instruction mnemonics to their types.
-        # The type determines the instruction format.
-instrType = {
-    "nop": 0, "ret": 0, "hlt": 0, "call": 1, "b": 1, "beq": 1,
-    "bgt": 1, "add": 3, "addh": 3, "addu": 3, "sub": 3, "subh": 3,
-    "subu": 3, "mul": 3, "mulh": 3, "mulu": 3, "div": 3, "divh": 3,
-    "divu": 3, "mod": 3, "modh": 3, "modu": 3, "or": 3, "orh": 3,
-    "oru": 3, "lsl": 3, "lslh": 3, "lslu": 3, "lsr": 3, "lsrh": 3,
-    "lsru": 3, "asr": 3, "asrh": 3, "asru": 3, "cmp": 2, "not": 2,
-    "noth": 2, "notu": 2, "and": 3, "andh": 3, "andu": 3, "mov": 2,
-    "movh": 2, "movu": 2, "ld": 4, "st": 4
+# Program column that holds the value of each bit field.
+fieldColumn = {
+    "opcode": "op", "i": "roi", "rd": "rd", "rs1": "rs1", "rs2": "rs2",
+    "mod": "mod", "imm": "imm", "offset": "imm", "memimm": "imm"
 }
 
-                # Dictionary to hold labels and their corresponding line numbers or addresses.
-label = {}
+class Program:
+    """
+    Compact store for assembled instructions.
+    Each instruction is one row across parallel array columns instead of
+    a list of strings; the encoded 32-bit words live in 'words'.
+    Type 1 rows keep their label operand in 'ref' until it is resolved
+    into 'imm' as an offset.
+    """
+    __slots__ = ("op", "type", "roi", "rd", "rs1", "rs2", "mod", "imm", "line",
+                 "ref", "words")
+
+    def __init__(self):
+        self.op = array('B')
+        self.type = array('B')
+        self.roi = array('B')
+        self.rd = array('B')
+        self.rs1 = array('B')
+        self.rs2 = array('B')
+        self.mod = array('B')
+        self.imm = array('I')     # Low word bits; encode() keeps the field width.
+        self.line = array('I')    # Source line index of each row.
+        self.ref = {}
+        self.words = array('I')
+
+    def __len__(self):
+        return len(self.op)
+
+    def add(self, op, type_val, roi=0, rd=0, rs1=0, rs2=0, mod=0, imm=0, line=0):
+        """
+        Append one instruction row and return its index.
+        """
+        self.op.append(op)
+        self.type.append(type_val)
+        self.roi.append(roi)
+        self.rd.append(rd)
+        self.rs1.append(rs1)
+        self.rs2.append(rs2)
+        self.mod.append(mod)
+        self.imm.append(imm & wordMask)
+        self.line.append(line)
+        return len(self.op) - 1
+
+    def positions(self):
+        """
+        Return the position of every row in the units branch offsets use:
+        its source line plus the extra rows that lines before it (or
+        earlier in the same line) were expanded into.
+        """
+        pos = array('I')
+        extra = 0
+        prev = -1
+        for k in range(len(self.line)):
+            if self.line[k] == prev:
+                extra += 1
+            prev = self.line[k]
+            pos.append(self.line[k] + extra)
+        return pos
+
+    def linePosition(self, pos, line):
+        """
+        Return the position of source line 'line' given positions().
+        """
+        k = bisect.bisect_left(self.line, line)
+        if k < len(pos):
+            return pos[k] - self.line[k] + line
+        if k > 0:
+            return pos[k - 1] - self.line[k - 1] + line
+        return line
+
+    def encode(self):
+        """
+        Encode every row into 'words'.
+        The fields of each row come from its type's layout in isa.py
+        (register or immediate form, chosen by the I flag); each value is
+        cut to its field width and shifted into place.
+        """
+        plans = {}
+        for type_val in layout:
+            plans[type_val] = tuple(
+                tuple((getattr(self, fieldColumn[f]), fields[f][0], fieldMask[f]) for f in form)
+                for form in layout[type_val])
+        words = array('I')
+        for k in range(len(self.op)):
+            w = 0
+            for col, shift, mask in plans[self.type[k]][self.roi[k]]:
+                w |= (col[k] & mask) << shift
+            words.append(w)
+        self.words = words
+        return words
+
+# Estimated cycles per instruction, keyed by base mnemonic.
+# Anything not listed costs DEFAULT_LATENCY cycles.
+DEFAULT_LATENCY = 1
+latency = {
+    "mul": 3, "div": 12, "mod": 12,
+    "ld": 3, "st": 2,
+    "beq": 2, "bgt": 2, "b": 2, "call": 2, "ret": 2
+}
 
 def logError(msg):
     """
@@ -95,304 +186,782 @@ def inb(num, n):
         num //= 2
     return "".join(ans)
 
-def tc(num):
+def immediate(operand, logError=logError):
     """
-    Convert an integer to a 27-bit two's complement binary representation.
-    This handles both positive and negative numbers.
+    Return the integer value of an immediate operand, or None after
+    logging an error when it has no valid numeric part.
     """
-    bs = ""
-    in_val = 0
-    if num < 0:
-        num = -num
-        in_val = 1
-    while num != 0:
-        if num % 2 == 0:
-            bs = "0" + bs
-        else:
-            bs = "1" + bs
-        num //= 2
-    while len(bs) < 27:
-        bs = "0" + bs
-    if in_val:
-        # If the number was negative, flip bits to get the two's complement.
-        bs_list = list(bs)
-        for i in range(27):
-            bs_list[i] = '1' if bs_list[i] == '0' else '0'
-        bs = "".join(bs_list)
-        # Add one to the flipped bits.
-        c = 1
-        bs_list = list(bs)
-        for i in range(26, -1, -1):
-            bit = 1 if bs_list[i] == '1' else 0
-            bs_list[i] = chr((bit + c) % 2 + ord('0'))
-            c = (bit + c) // 2
-        bs = "".join(bs_list)
-    return bs
-
-def hti(hexStr):
-    """
-    Convert a hexadecimal string (with or without a leading 0x) to an integer.
-    """
-    result = 0
-    base_val = 1
-    if hexStr[:2] == "0x" or hexStr[:2] == "0X":
-        hexStr = hexStr[2:]
-    for i in range(len(hexStr) - 1, -1, -1):
-        c = hexStr[i]
-        digit = 0
-        if '0' <= c <= '9':
-            digit = ord(c) - ord('0')
-        elif 'A' <= c <= 'F':
-            digit = ord(c) - ord('A') + 10
-        elif 'a' <= c <= 'f':
-            digit = ord(c) - ord('a') + 10
-        result += digit * base_val
-        base_val *= 16
-    return result
+    u = en(operand)
+    if u == "":
+        logError("Error: No numeric part found in operand: " + operand)
+        return None
+    try:
+        return int(u, 0)
+    except ValueError:
+        logError("Invalid numeric operand: " + operand)
+        return None
 
-def main():
-    global inputline, err, mc, opcodes, reg, instrType, label
+def addSequence(op, rd, rs, value):
+    """
+    Return the shortest instruction sequence (as token lists) that sets
+    rd to value, or to rs + value / rs - value when 'op' is "add" / "sub"
+    (with 'op' "mov", rs is ignored). Default immediates are
+    sign-extended, 'u' ones zero-extended and 'h' ones shifted into the
+    upper half.
+    """
+    bits = fields["imm"][1]
+    mask = fieldMask["imm"]
+    u = value & wordMask
+    s = u - (wordMask + 1) if u > wordMask >> 1 else u
+    src = [] if op == "mov" else [rs]
+    if -(mask + 1) >> 1 <= s <= mask >> 1:
+        return [[op, rd] + src + [str(s)]]
+    if u <= mask:
+        return [[op + "u", rd] + src + [str(u)]]
+    if u & mask == 0:
+        return [[op + "h", rd] + src + [str(u >> bits)]]
+    low = "addu" if op == "mov" else op + "u"
+    return [[op + "h", rd] + src + [str(u >> bits)], [low, rd, rd, str(u & mask)]]
+
+def literal(operand):
+    """
+    Return the value of a numeric literal: decimal or 0x hex with an
+    optional sign. Raises ValueError for anything else.
+    """
+    m = re.fullmatch(r"([+-]?)(?:0[xX]([0-9a-fA-F]+)|([0-9]+))", operand)
+    if m is None:
+        raise ValueError("Invalid numeric operand: " + operand)
+    value = int(m.group(2), 16) if m.group(2) else int(m.group(3))
+    return -value if m.group(1) == "-" else value
+
+def expandPseudo(tokens):
+    """
+    Expand pseudo-instructions into the real instructions they stand for.
+    Returns a list of token lists; ordinary instructions come back as is.
+    li rX, imm     loads any word sized constant (one instruction if it fits).
+    ld/st far      offsets outside the memimm field are added to the base
+                   register first. ld adds into rd; st adds into the base
+                   itself and subtracts it again afterwards, so no other
+                   register is touched. The offset must fit in a word.
+    Raises ValueError with a message for malformed pseudo-instructions.
+    """
+    op = tokens[0].lower()
+    if op == "li":
+        if len(tokens) < 3:
+            raise ValueError("Error: Not enough operands for li")
+        value = literal(tokens[2])
+        if value < -(wordMask + 1) >> 1 or value > wordMask:
+            raise ValueError("Error: Constant does not fit in a word: " + tokens[2])
+        return addSequence("mov", tokens[1], None, value)
+    if (op == "ld" or op == "st") and len(tokens) >= 3:
+        imv = tokens[2]
+        lb = imv.find('[')
+        rb = imv.find(']')
+        num = en(imv[:lb]) if lb != -1 and rb != -1 else ""
+        try:
+            off = int(num, 0)
+        except ValueError:
+            # Leave malformed operands for the encoder to report.
+            return [tokens]
+        if 0 <= off <= fieldMask["memimm"]:
+            return [tokens]
+        if off < -(wordMask + 1) >> 1 or off > wordMask:
+            raise ValueError("Error: Offset does not fit in a word: " + imv[:lb])
+        rs1 = imv[lb + 1:rb]
+        tmp = tokens[1]
+        if op == "st":
+            tmp = rs1
+            if tokens[1].lower() == rs1.lower():
+                raise ValueError("Error: Far st cannot store its own base register: "
+                                 + tokens[1])
+        # Leave some offset bits for the instruction itself when that saves an add.
+        best = None
+        for low in range(fieldMask["memimm"] + 1):
+            seq = addSequence("add", tmp, rs1, off - low)
+            if best is None or len(seq) < len(best[0]):
+                best = (seq, low)
+        seq, low = best
+        seq = seq + [[tokens[0], tokens[1], str(low) + "[" + tmp + "]"]]
+        if op == "st":
+            # Restore the base register.
+            seq += addSequence("sub", rs1, rs1, off - low)
+        return seq
+    return [tokens]
+
+def fileDigest(path, size):
+    """
+    Return the SHA-256 digest of a file, or None if it is missing or
+    not 'size' bytes long (a size mismatch already means it differs).
+    """
     try:
-        # Open the input file containing assembly instructions.
-        inputfile = open("input.txt", "r")
-    except:
-        logError("Error: File Could Not Be Opened.")
-        return 1
+        if os.path.getsize(path) != size:
+            return None
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            chunk = f.read(65536)
+            while chunk:
+                h.update(chunk)
+                chunk = f.read(65536)
+        return h.digest()
+    except OSError:
+        return None
+
+def writeHex(path, words):
+    """
+    Write encoded words to a hex file, one 8 digit word per line.
+    See writeFile() for when and how the file is replaced.
+    """
+    return writeFile(path, "".join(["%08X%s" % (w, os.linesep) for w in words]))
+
+def writeFile(path, text):
+    """
+    Write 'text' to 'path' unless the file already holds exactly that.
+    Nothing is written when the content is unchanged, so watchers do not
+    fire on a no-op assemble. Otherwise the data goes to a temporary file
+    in the same directory which is then renamed over 'path', so readers
+    never see a partial file.
+    Returns True if the file was replaced, False if it was unchanged.
+    """
+    data = text.encode("ascii")
+    if fileDigest(path, len(data)) == hashlib.sha256(data).digest():
+        return False
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".tmp",
+                               dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # Keep the permissions of the file being replaced; mkstemp uses 0600.
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return True
+
+def readImage(path):
+    """
+    Read a previously assembled image into an array of words.
+    Files ending in .hex hold one hex word per line (as written by
+    writeHex()); anything else is read as raw big-endian 32 bit words.
+    """
+    words = array('I')
+    if path.lower().endswith(".hex"):
+        with open(path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line != "":
+                    words.append(int(line, 16))
     else:
-        print("File Opened Successfully.")
-        # Read each line from the file, stripping newline characters.
-        for line in inputfile:
-            inputline.append(line.rstrip("\n"))
-    inputfile.close()
-    if DEBUG:
-        print("File Opened Successfully. Total lines:", len(inputline))
-    
-    # Parse each line to remove comments and extra characters.
-    for i in range(len(inputline)):
-        inputline[i] = parser(inputline[i])
-        if DEBUG:
-            print("After parsing, line", i + 1, ":", inputline[i])
-    
-    # First pass: scan for labels and store their line numbers.
-    for i in range(len(inputline)):
-        tokens = inputline[i].split()
-        for token in tokens:
-            if ':' in token:
-                if token[-1] == ':':
-                    labelName = token[:-1]
-                    label[labelName] = i + 1
-                    if DEBUG:
-                        print("Label found:", labelName, "at line", i + 1)
-    
-    # Second pass: process each instruction to generate machine code.
-    for i in range(len(inputline)):
-        ss = inputline[i].split()
-        tokens = []
-        for token in ss:
-            if ':' not in token:
-                tokens.append(token)
-            elif token[-1] == ':':
-                # Also update label info if the token is a label.
-                label[token[:-1]] = i + 1
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) % 4 != 0:
+            raise ValueError("binary image is not a whole number of words")
+        words.frombytes(data)
+        if sys.byteorder == "little":
+            words.byteswap()
+    return words
+
+def diffImage(old, new, gap=2):
+    """
+    Compare two images and return the changed address ranges of 'new'
+    as (start, count) runs. Words past the end of 'old' count as changed.
+    Runs separated by at most 'gap' unchanged words are merged, since
+    resending a few words is cheaper than starting another run.
+    """
+    runs = []
+    n = len(new)
+    m = len(old)
+    a = 0
+    while a < n:
+        if a < m and old[a] == new[a]:
+            a += 1
+            continue
+        start = a
+        end = a + 1
+        # Extend the run while the next change is within 'gap' words.
+        b = end
+        while b < n and b - end <= gap:
+            if b >= m or old[b] != new[b]:
+                end = b + 1
+            b += 1
+        runs.append((start, end - start))
+        a = end
+    return runs
+
+def patchText(runs, old, new):
+    """
+    Format a patch for the flashing rig.
+    Lines starting with '#' are comments. Each run is a line
+    "@AAAAAAAA N" (hex word address, decimal word count) followed by N
+    lines holding one 8 digit hex word each. A final "#size N" line is
+    present when the image length changed.
+    """
+    changed = 0
+    for a in range(len(new)):
+        if a >= len(old) or old[a] != new[a]:
+            changed += 1
+    sent = sum(count for start, count in runs)
+    out = ["# words %d changed %d runs %d sent %d" % (len(new), changed, len(runs), sent)]
+    for start, count in runs:
+        out.append("@%08X %d" % (start, count))
+        for a in range(start, start + count):
+            out.append("%08X" % new[a])
+    if len(old) != len(new):
+        out.append("#size %d" % len(new))
+    return "".join([line + os.linesep for line in out]), changed, sent
+
+def loadLatency(path):
+    """
+    Read a latency table from a file and merge it into 'latency'.
+    Each line holds a mnemonic followed by its cycle count, e.g. "mul 4".
+    Comments and commas are handled the same way as in assembly source.
+    """
+    f = open(path, "r")
+    for line in f:
+        tokens = parser(line.rstrip("\n")).split()
         if len(tokens) == 0:
             continue
+        if len(tokens) < 2 or tokens[0].lower() not in opcodes:
+            logError("Error: Bad latency entry: " + line.strip())
+            continue
+        latency[tokens[0].lower()] = int(tokens[1], 0)
+    f.close()
 
+def decodeOp(word):
+    """
+    Return the base mnemonic of an encoded 32-bit word.
+    """
+    code = (word >> fields["opcode"][0]) & fieldMask["opcode"]
+    return decode[code][0] if code in decode else "?"
+
+def buildCFG(words, pos):
+    """
+    Split an encoded image into basic blocks and link them.
+    'pos' gives the position of every word (see Program.positions());
+    type 1 offsets are relative to the branch's own position, so targets
+    are resolved to the first word at or after the target position.
+    Returns a list of blocks, each a dict with start, end (exclusive),
+    ops, succ (block indices) and call (callee block indices).
+    """
+    n = len(words)
+    ops = [decodeOp(w) for w in words]
+    targets = [None] * n
+    leaders = set()
+    if n > 0:
+        leaders.add(0)
+    for a in range(n):
+        op = ops[a]
+        if instrType.get(op) == 1:
+            mask = fieldMask["offset"]
+            off = (words[a] >> fields["offset"][0]) & mask
+            if off > mask >> 1:
+                off -= mask + 1
+            t = bisect.bisect_left(pos, pos[a] + off)
+            if t < n:
+                targets[a] = t
+                leaders.add(t)
+        if instrType.get(op) == 1 or op == "ret" or op == "hlt":
+            if a + 1 < n:
+                leaders.add(a + 1)
+
+    starts = sorted(leaders)
+    blockOf = {}
+    blocks = []
+    for k in range(len(starts)):
+        end = starts[k + 1] if k + 1 < len(starts) else n
+        blockOf[starts[k]] = k
+        blocks.append({"start": starts[k], "end": end, "ops": ops[starts[k]:end],
+                       "succ": [], "call": []})
+
+    for blk in blocks:
+        last = blk["end"] - 1
+        op = ops[last]
+        fall = blockOf.get(blk["end"])
+        if op == "b":
+            if targets[last] is not None:
+                blk["succ"].append(blockOf[targets[last]])
+        elif op == "beq" or op == "bgt":
+            if targets[last] is not None:
+                blk["succ"].append(blockOf[targets[last]])
+            if fall is not None and fall not in blk["succ"]:
+                blk["succ"].append(fall)
+        elif op == "call":
+            if targets[last] is not None:
+                blk["call"].append(blockOf[targets[last]])
+            if fall is not None:
+                blk["succ"].append(fall)
+        elif op != "ret" and op != "hlt" and fall is not None:
+            blk["succ"].append(fall)
+    return blocks
+
+def findLoops(blocks):
+    """
+    Find natural loops from the back edges of the control flow graph: an
+    edge whose target dominates its source. Block 0 and every call target
+    are entries, as is any block none of them reaches. Edges into a block
+    that does not dominate them (irreducible flow) form no loop.
+    Returns a list of loops, each a dict with header and body (a set of
+    block indices). Back edges sharing a header are merged into one loop.
+    """
+    n = len(blocks)
+    roots = [0] if blocks else []
+    for blk in blocks:
+        for c in blk["call"]:
+            if c not in roots:
+                roots.append(c)
+    seen = set()
+    work = list(roots)
+    for k in range(n):
+        if k not in seen and not work:
+            roots.append(k)
+            work.append(k)
+        while work:
+            b = work.pop()
+            if b not in seen:
+                seen.add(b)
+                work.extend(blocks[b]["succ"])
+
+    # Dominators over a virtual root (index n) that leads to every entry.
+    succ = [blk["succ"] for blk in blocks] + [roots]
+    pred = [[] for _ in range(n + 1)]
+    for b in range(n + 1):
+        for s in succ[b]:
+            pred[s].append(b)
+    order = []
+    state = [0] * (n + 1)
+    stack = [(n, 0)]
+    state[n] = 1
+    while stack:
+        b, k = stack[-1]
+        if k < len(succ[b]):
+            stack[-1] = (b, k + 1)
+            s = succ[b][k]
+            if not state[s]:
+                state[s] = 1
+                stack.append((s, 0))
+        else:
+            order.append(b)
+            stack.pop()
+    order.reverse()
+    dom = [None] * (n + 1)
+    dom[n] = {n}
+    changed = True
+    while changed:
+        changed = False
+        for b in order[1:]:
+            new = None
+            for p in pred[b]:
+                if dom[p] is not None:
+                    new = set(dom[p]) if new is None else new & dom[p]
+            new.add(b)
+            if new != dom[b]:
+                dom[b] = new
+                changed = True
+
+    loops = {}
+    for tail in range(n):
+        for head in blocks[tail]["succ"]:
+            if head not in dom[tail]:
+                continue
+            body = loops.setdefault(head, {head})
+            work = [tail]
+            while work:
+                b = work.pop()
+                if b in body:
+                    continue
+                body.add(b)
+                work.extend(pred[b])
+    return [{"header": h, "body": loops[h]} for h in sorted(loops)]
+
+def cycleReport(words, pos, lines, trip=10, sortKey="weighted"):
+    """
+    Estimate cycles per basic block and per loop of an encoded image.
+    Blocks cost the sum of their instruction latencies plus, for a block
+    ending in a call, the cost of the function it calls. A loop costs the
+    sum of its blocks per iteration, with inner loops assumed to run
+    'trip' times. 'weighted' scales a cost by 'trip' for every loop level
+    it sits in, counting the loops around its deepest call site for code
+    in a function, so hot code rises to the top when sorting by it.
+    'pos' and 'lines' give the position and source line of every word.
+    Returns a list of report rows (dicts) sorted by 'sortKey'.
+    """
+    blocks = buildCFG(words, pos)
+    loops = findLoops(blocks)
+    depth = [0] * len(blocks)
+    for lp in loops:
+        for b in lp["body"]:
+            depth[b] += 1
+    for blk in blocks:
+        blk["cycles"] = 0
+        for op in blk["ops"]:
+            blk["cycles"] += latency.get(op, DEFAULT_LATENCY)
+
+    # Blocks of every function, found from its entry without following calls.
+    entries = [0] if blocks else []
+    for blk in blocks:
+        for c in blk["call"]:
+            if c not in entries:
+                entries.append(c)
+    region = {}
+    for e in entries:
+        body = set()
+        work = [e]
+        while work:
+            b = work.pop()
+            if b not in body:
+                body.add(b)
+                work.extend(blocks[b]["succ"])
+        region[e] = body
+
+    # Cost of one call of each function, including what it calls in turn.
+    # Calls are not edges, so a block's depth only counts loops of its own
+    # function, the entry's loop included. Recursive calls are counted once.
+    cost = {}
+    def funcCost(e):
+        if e not in cost:
+            cost[e] = 0
+            total = 0
+            for b in region[e]:
+                own = blocks[b]["cycles"] + sum(funcCost(c) for c in blocks[b]["call"])
+                total += own * trip ** depth[b]
+            cost[e] = total
+        return cost[e]
+    for e in entries:
+        funcCost(e)
+
+    # Code in a function sits as deep as the deepest loop it is called from.
+    outer = {e: 0 for e in entries}
+    for _ in range(len(entries)):
+        changed = False
+        for e in entries:
+            for b in region[e]:
+                for c in blocks[b]["call"]:
+                    d = outer[e] + depth[b]
+                    if d > outer[c]:
+                        outer[c] = d
+                        changed = True
+        if not changed:
+            break
+    eff = list(depth)
+    for e in entries:
+        for b in region[e]:
+            eff[b] = max(eff[b], depth[b] + outer[e])
+
+    rows = []
+    for k in range(len(blocks)):
+        blk = blocks[k]
+        cycles = blk["cycles"] + sum(cost[c] for c in blk["call"])
+        blk["total"] = cycles
+        rows.append({"kind": "block", "name": "B" + str(k), "start": blk["start"],
+                     "end": blk["end"] - 1, "line": lines[blk["start"]] + 1,
+                     "size": blk["end"] - blk["start"], "cycles": cycles,
+                     "depth": eff[k], "weighted": cycles * trip ** eff[k]})
+    for lp in loops:
+        body = sorted(lp["body"])
+        h = lp["header"]
+        cycles = sum(blocks[b]["total"] * trip ** (depth[b] - depth[h]) for b in body)
+        rows.append({"kind": "loop", "name": "L" + str(h),
+                     "start": min(blocks[b]["start"] for b in body),
+                     "end": max(blocks[b]["end"] for b in body) - 1,
+                     "line": lines[blocks[h]["start"]] + 1,
+                     "size": sum(blocks[b]["end"] - blocks[b]["start"] for b in body),
+                     "cycles": cycles, "depth": eff[h], "weighted": cycles * trip ** eff[h]})
+
+    if sortKey in ("start", "line"):
+        rows.sort(key=lambda r: (r[sortKey], r["kind"]))
+    else:
+        rows.sort(key=lambda r: (-r[sortKey], r["start"]))
+    return rows
+
+def printReport(rows):
+    """
+    Print report rows from cycleReport() as an aligned table.
+    """
+    print("%-6s %-6s %-9s %-6s %-6s %-8s %-6s %s" % ("kind", "name", "addr", "line",
+                                                   "size", "cycles", "depth", "weighted"))
+    for r in rows:
+        addr = "%d-%d" % (r["start"], r["end"])
+        print("%-6s %-6s %-9s %-6d %-6d %-8d %-6d %d" % (r["kind"], r["name"], addr, r["line"],
+                                                       r["size"], r["cycles"], r["depth"],
+                                                       r["weighted"]))
+
+def splitLine(line):
+    """
+    Parse one source line into its label definitions and instruction tokens.
+    Returns (labels, tokens, line) where line is the cleaned line.
+    """
+    line = parser(line.rstrip("\n"))
+    labels = []
+    tokens = []
+    for token in line.split():
+        if ':' not in token:
+            tokens.append(token)
+        elif token[-1] == ':':
+            labels.append(token[:-1])
+    return labels, tokens, line
+
+def addLine(prog, tokens, i, line, logError=logError):
+    """
+    Add the instruction on source line 'i' to 'prog', expanding
+    pseudo-instructions first. Branches to labels are left in prog.ref
+    for assemble() to resolve. Problems are passed to 'logError' and the
+    offending instruction is skipped.
+    """
+    # Pseudo-instructions expand into one or more real instructions.
+    try:
+        expanded = expandPseudo(tokens)
+    except ValueError as e:
+        logError(str(e))
+        return
+    for tokens in expanded:
         op = tokens[0].lower()    # Get the opcode in lowercase.
-        type_val = instrType[op]  # Determine instruction type.
-        ans = ""
+        if op not in mnemonic:
+            logError("Unknown opcode: " + op)
+            continue
+        # Base opcode, instruction type and the modifier of a u/h suffix.
+        base, opc, type_val, mod = mnemonic[op]
 
         if type_val == 0:
             # Type 0 instructions: no operands.
-            opp = opcodes[op]
-            ans += opp
-            # Pad remaining bits with zeros to make 32 bits.
-            while len(ans) < 32:
-                ans += '0'
-            mc.append(ans)
+            prog.add(opc, 0, line=i)
         elif type_val == 1:
             # Type 1 instructions: branch instructions.
-            opp = opcodes[op]
-            ans += opp
+            if len(tokens) < 2:
+                logError("Error: Not enough operands for " + op)
+                continue
             op1 = tokens[1]
-            g = False
-            # Check if the operand is a hexadecimal literal.
-            if op1[0] == '0' and (op1[1] == 'x' or op1[1] == 'X'):
-                label[op1] = hti(op1)
-                g = True
-            # Calculate the offset relative to the current instruction.
-            y = -i + label[op1]
-            off = tc(y)
-            if g:
-                # If a hex literal was used, convert the label value directly.
-                off = tc(label[op1])
-            ans += off
-            mc.append(ans)
+            if op1[0] == '0' and len(op1) > 1 and (op1[1] == 'x' or op1[1] == 'X'):
+                # A hex literal is used as the offset directly.
+                try:
+                    prog.add(opc, 1, imm=int(op1, 16), line=i)
+                except ValueError:
+                    logError("Invalid hex operand: " + op1)
+                continue
+            row = prog.add(opc, 1, line=i)
+            prog.ref[row] = op1
         elif type_val == 2:
             # Type 2 instructions: one register and one immediate or register operand.
             if len(tokens) < 3:
                 logError("Error: Not enough operands for " + op)
                 continue
-            opp = opcodes[op]
-            op1 = tokens[1]
+            op1 = tokens[1].lower()
             op2 = tokens[2]
             if op1 not in reg:
-                logError("Unknown register: " + op1)
+                logError("Unknown register: " + tokens[1])
                 continue
             if op2[0] == 'r' or op2[0] == 'R':
                 # When the second operand is a register.
-                ans += opp
-                ans += '0'
-                ans += reg[op1]
-                ans += "0000"
-                ans += reg[op2]
-                while len(ans) < 32:
-                    ans += '0'
-                mc.append(ans)
+                if op2.lower() not in reg:
+                    logError("Unknown register: " + op2)
+                    continue
+                prog.add(opc, 2, rd=regNum[op1], rs2=regNum[op2.lower()], line=i)
             else:
                 # When the second operand is an immediate value.
-                mod = "00"
-                if len(op) == 4:
-                    if op[3] == 'u':
-                        mod = "01"
-                    else:
-                        mod = "10"
-                    opp = op[:-1]
-                else:
-                    opp = tokens[0]
-                ans += opcodes[opp]
-                ans += '1'
-                ans += reg[op1]
-                ans += "0000"
-                u = en(op2)
-                if u == "":
-                    logError("Error: No numeric part found in operand: " + op2)
+                k = immediate(op2, logError)
+                if k is None:
                     continue
-                k = int(u, 0)
-                imm = inb(k, 16)
-                ans += mod
-                ans += imm
-                mc.append(ans)
+                prog.add(opc, 2, roi=1, rd=regNum[op1], mod=mod, imm=k, line=i)
         elif type_val == 3:
             # Type 3 instructions: two registers and one register/immediate operand.
             if len(tokens) < 4:
                 logError("Error: Not enough operands for " + op)
                 continue
-            op = tokens[0]
-            op1 = tokens[1]
-            op2 = tokens[2]
+            op1 = tokens[1].lower()
+            op2 = tokens[2].lower()
             op3 = tokens[3]
-            if op1 not in reg:
-                logError("Unknown register: " + op1)
+            if op1 not in reg or op2 not in reg:
+                logError("Unknown register: " + (tokens[1] if op1 not in reg else tokens[2]))
                 continue
             if op3[0] == 'r' or op3[0] == 'R':
-                if op3 not in reg:
+                if op3.lower() not in reg:
                     logError("Unknown register: " + op3)
                     continue
-                opp2 = opcodes[op]
-                ans += opp2
-                ans += '0'
-                ans += reg[op1]
-                ans += reg[op2]
-                ans += reg[op3]
-                while len(ans) < 32:
-                    ans += '0'
-                mc.append(ans)
+                prog.add(opc, 3, rd=regNum[op1], rs1=regNum[op2],
+                         rs2=regNum[op3.lower()], line=i)
             else:
                 # When the third operand is an immediate value.
-                mod = "00"
-                if len(op) == 4:
-                    if op[3] == 'u':
-                        mod = "01"
-                    else:
-                        mod = "10"
-                    opp2 = op[:-1]
-                else:
-                    opp2 = op
-                ans += opcodes[opp2]
-                ans += '1'
-                ans += reg[op1]
-                ans += reg[op2]
-                u = en(op3)
-                if u == "":
-                    logError("Error: No numeric part found in operand: " + op3)
-                else:
-                    k = int(u, 0)
-                    imm = inb(k, 16)
-                    ans += mod
-                    ans += imm
-                    mc.append(ans)
+                k = immediate(op3, logError)
+                if k is None:
+                    continue
+                prog.add(opc, 3, roi=1, rd=regNum[op1], rs1=regNum[op2],
+                         mod=mod, imm=k, line=i)
         elif type_val == 4:
             # Type 4 instructions: memory operations (load and store).
             if len(tokens) < 3:
                 logError("Error: Not enough operands for " + op)
                 continue
-            rd = tokens[1]
+            rd = tokens[1].lower()
             imv = tokens[2]
             lb = imv.find('[')
             rb = imv.find(']')
             if lb == -1 or rb == -1:
-                logError("Error: Memory operand format error in: " + inputline[i])
+                logError("Error: Memory operand format error in: " + line)
                 continue
             imm = imv[:lb]
-            rs1 = imv[lb + 1:rb]
+            rs1 = imv[lb + 1:rb].lower()
             if rd not in reg or rs1 not in reg:
-                logError("Unknown register in memory operand: " + inputline[i])
+                logError("Unknown register in memory operand: " + line)
                 continue
-            num = en(imm)
-            if num == "":
-                logError("Error: No numeric part found in immediate operand: " + imm)
+            k = immediate(imm, logError)
+            if k is None:
                 continue
-            immv = int(num, 0)
-            imb = inb(immv, 4)
-            roi = "1"
-            #Encoding part: opcode, roi flag, destination register, source register.
-            ans = opcodes[op] + roi + reg[rd] + reg[rs1]
-            x = 14
-            # Pad with zeros to reach the required bit length.
-            while x > 0:
-                ans += '0'
-                x -= 1
-            ans += imb
-            mc.append(ans)
-    
-    # Output the generated 32-bit machine code for each instruction.
-    for i in range(len(mc)):
-        print(mc[i])
-    
-    # Write the machine code to a hex file.
+            prog.add(opc, 4, roi=1, rd=regNum[rd], rs1=regNum[rs1], imm=k, line=i)
+
+def checkLine(line):
+    """
+    Return the errors assemble() reports for one source line on its own.
+    Undefined labels need the whole program and are not checked.
+    """
+    errors = []
+    labels, tokens, line = splitLine(line)
+    if tokens:
+        addLine(Program(), tokens, 0, line, errors.append)
+    return errors
+
+def assemble(lines, logError=logError):
+    """
+    Assemble source lines into an encoded Program.
+    Each line is parsed and tokenized once and stored as a Program row;
+    branch targets are resolved after all labels are known. Problems are
+    passed to 'logError' and the offending instruction is skipped.
+    Both the command line and the GUI assembler use this.
+    """
+    prog = Program()
+    label = {}
+    i = -1
+    for i, line in enumerate(lines):
+        labels, tokens, line = splitLine(line)
+        if DEBUG:
+            print("After parsing, line", i + 1, ":", line)
+        for name in labels:
+            # Labels refer to the line that follows them.
+            label[name] = i + 1
+            if DEBUG:
+                print("Label found:", name, "at line", i + 1)
+        if len(tokens) > 0:
+            addLine(prog, tokens, i, line, logError)
+    if DEBUG:
+        print("Total lines:", i + 1, "instructions:", len(prog))
+
+    # Resolve branch targets now that every label is known. Offsets count
+    # source lines plus the extra instructions pseudo-instructions added.
+    pos = prog.positions()
+    for row in prog.ref:
+        op1 = prog.ref[row]
+        if op1 in label:
+            # Calculate the offset relative to the current instruction.
+            prog.imm[row] = (prog.linePosition(pos, label[op1]) - pos[row]) & wordMask
+        else:
+            logError("Undefined label: " + op1)
+    prog.encode()
+    return prog
+
+def printErrors():
+    """
+    Print the logged errors to stderr.
+    """
+    for e in err:
+        print(e, file=sys.stderr)
+
+def parseArgs(argv):
+    """
+    Parse the command line options.
+    """
+    ap = argparse.ArgumentParser(description="Assemble input.txt into hexfile.hex.")
+    ap.add_argument("--cycles", action="store_true",
+                    help="print an estimated cycle report per basic block and loop")
+    ap.add_argument("--latency", metavar="FILE",
+                    help="per-opcode latency table ('mnemonic cycles' per line)")
+    ap.add_argument("--sort", default="weighted",
+                    choices=["weighted", "cycles", "size", "depth", "start", "line"],
+                    help="report sort key (default: weighted)")
+    ap.add_argument("--trip", type=int, default=10,
+                    help="assumed iterations per loop when weighting (default: 10)")
+    ap.add_argument("--patch", metavar="OLD",
+                    help="write hexfile.patch with the words that differ from the image in "
+                         "OLD (.hex or raw big-endian binary)")
+    ap.add_argument("--gap", type=int, default=2,
+                    help="merge patch runs separated by at most this many words (default: 2)")
+    return ap.parse_args(argv)
+
+def main():
+    args = parseArgs(sys.argv[1:])
+    if args.latency:
+        try:
+            loadLatency(args.latency)
+        except (OSError, ValueError):
+            logError("Error: Latency table could not be read: " + args.latency)
+        if len(err) > 0:
+            printErrors()
+            return 1
+    # Read the previous image first, it may be the hexfile.hex we overwrite.
+    oldImage = None
+    if args.patch:
+        try:
+            oldImage = readImage(args.patch)
+        except FileNotFoundError:
+            print(args.patch + " not found, patch will hold the whole image")
+            oldImage = array('I')
+        except (OSError, ValueError):
+            logError("Error: Previous image could not be read: " + args.patch)
+            printErrors()
+            return 1
     try:
-        hexfile = open("hexfile.hex", "w")
+        # Open the input file containing assembly instructions.
+        inputfile = open("input.txt", "r")
     except:
+        logError("Error: File Could Not Be Opened.")
+        printErrors()
+        return 1
+    print("File Opened Successfully.")
+
+    prog = assemble(inputfile)
+    inputfile.close()
+    pos = prog.positions()
+
+    # Output the generated 32-bit machine code for each instruction.
+    for word in prog.words:
+        print(inb(word, 32))
+
+    # Write the machine code to a hex file, skipping it if nothing changed.
+    try:
+        written = writeHex("hexfile.hex", prog.words)
+    except OSError:
         logError("Error: Could not create hexfile.hex!")
+        printErrors()
         return 1
-    
-    for mc_line in mc:
-        val = 0
-        base_val = 1
-        # Convert the binary string to an integer.
-        for j in range(len(mc_line) - 1, -1, -1):
-            if mc_line[j] == '1':
-                val += base_val
-            base_val *= 2
-        ans_hex = ""
-        if val == 0:
-            ans_hex = "0"
-        # Convert the integer to its hexadecimal representation.
-        while val > 0:
-            r = val % 16
-            if r < 10:
-                ans_hex = chr(r + ord('0')) + ans_hex
-            else:
-                ans_hex = chr(r - 10 + ord('A')) + ans_hex
-            val //= 16
-        # Pad the hexadecimal string to ensure 8 hex digits.
-        while len(ans_hex) < 8:
-            ans_hex = "0" + ans_hex
-        hexfile.write(ans_hex + "\n")
-    
-    hexfile.close()
-    print("Machine code stored in hexfile.hex")
-    
+    if written:
+        print("Machine code stored in hexfile.hex")
+    else:
+        print("hexfile.hex is up to date")
+
+    if oldImage is not None:
+        runs = diffImage(oldImage, prog.words, args.gap)
+        text, changed, sent = patchText(runs, oldImage, prog.words)
+        try:
+            writeFile("hexfile.patch", text)
+        except OSError:
+            logError("Error: Could not create hexfile.patch!")
+            printErrors()
+            return 1
+        print("Patch stored in hexfile.patch: %d of %d words changed, %d runs, %d words sent"
+              % (changed, len(prog.words), len(runs), sent))
+
+    if args.cycles:
+        printReport(cycleReport(prog.words, pos, prog.line, args.trip, args.sort))
+
     # If any errors were encountered, print them out.
     if len(err) > 0:
         print("Errors encountered during assembly")
@@ -401,4 +970,4 @@ def main():
     return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
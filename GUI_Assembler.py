@@ -1,260 +1,133 @@
 import sys
+import re
+import functools
+from PyQt5.QtCore import QEvent
+from PyQt5.QtGui import QSyntaxHighlighter, QTextCharFormat, QColor, QFont
 from PyQt5.QtWidgets import (QApplication, QWidget, QPlainTextEdit, QPushButton,
-                             QVBoxLayout, QHBoxLayout, QLabel, QGridLayout, QFileDialog)
+                             QVBoxLayout, QHBoxLayout, QLabel, QGridLayout, QFileDialog,
+                             QToolTip)
+from Assembler import assemble, writeHex, checkLine
+import isa
 
-opcodes = {
-    "add": "00000", "sub": "00001", "mul": "00010", "div": "00011",
-    "mod": "00100", "cmp": "00101", "and": "00110", "or": "00111",
-    "not": "01000", "mov": "01001", "lsl": "01010", "lsr": "01011",
-    "asr": "01100", "nop": "01101", "ld": "01110", "st": "01111",
-    "beq": "10000", "bgt": "10001", "b": "10010", "call": "10011",
-    "ret": "10100", "hlt": "11111"
-}
-reg = {
-    "r1": "0001", "r2": "0010", "r3": "0011", "r4": "0100",
-    "r5": "0101", "r6": "0110", "r7": "0111", "r8": "1000",
-    "r9": "1001", "r10": "1010", "r11": "1011", "r12": "1100",
-    "r13": "1101", "r14": "1110", "r0": "0000"
-}
-instrType = {
-    "nop": 0, "ret": 0, "hlt": 0,
-    "call": 1, "b": 1, "beq": 1, "bgt": 1,
-    "add": 3, "addh": 3, "addu": 3,
-    "sub": 3, "subh": 3, "subu": 3,
-    "mul": 3, "mulh": 3, "mulu": 3,
-    "div": 3, "divh": 3, "divu": 3,
-    "mod": 3, "modh": 3, "modu": 3,
-    "or": 3, "orh": 3, "oru": 3,
-    "lsl": 3, "lslh": 3, "lslu": 3,
-    "lsr": 3, "lsrh": 3, "lsru": 3,
-    "asr": 3, "asrh": 3, "asru": 3,
-    "cmp": 2, "not": 2, "noth": 2, "notu": 2,
-    "and": 3, "andh": 3, "andu": 3,
-    "mov": 2, "movh": 2, "movu": 2,
-    "ld": 4, "st": 4
-}
-
-def parser(line):
-    ns = 0
-    t = ""
-    for ch in line:
-        if ch == ' ' and ns == 0:
-            t += ch
-            ns += 1
-            continue
-        if ch == ',':
-            t += ' '
-            continue
-        if ch == '/' or ch == ';':
-            break
-        t += ch
-    return t
-
-def en(s):
-    st = 0
-    while st < len(s) and not (s[st].isdigit() or s[st] == '-'):
-        st += 1
-    return s[st:]
+# Instruction set tables shared with Assembler.py, see isa.py.
+ISA = isa.load()
+reg = ISA["reg"]
+mnemonic = ISA["mnemonic"]
+operands = ISA["operands"]
+pseudo = ISA["pseudo"]
 
 def inb(num, n):
     return format(num, '0{}b'.format(n))
 
-def tc(num):
-    bits = 27
-    if num < 0:
-        num = (1 << bits) + num
-    return format(num, '0{}b'.format(bits))
+def assembleCode(input_text, write=True):
+    # Parsing and encoding are shared with the command line assembler.
+    errorContainer = []
+    prog = assemble(input_text.splitlines(), errorContainer.append)
+    words = prog.words
+    hexCode = ["%08X" % w for w in words]
+    if write:
+        try:
+            # Write to a default hex file (this can be bypassed with the Output File button)
+            writeHex("hexfile.hex", words)
+        except Exception:
+            errorContainer.append("Error: Could not create hexfile.hex!")
+    
+    return {"binaryCode": [inb(w, 32) for w in words], "hexCode": hexCode,
+            "words": words, "errors": errorContainer}
 
-def hti(hexStr):
-    if hexStr.lower().startswith("0x"):
-        hexStr = hexStr[2:]
-    return int(hexStr, 16)
+@functools.lru_cache(maxsize=8192)
+def lexLine(line):
+    """
+    Lex one source line for the editor. Returns a tuple of
+    (start, length, kind, message) spans; 'error' spans come last and
+    carry the messages checkLine() in Assembler.py gives, which runs the
+    same per-line code as assemble(). Each message is placed on the token
+    it names, or on the whole instruction when it names none.
+    Results are cached by line text, so unchanged and repeated lines
+    cost nothing to re-highlight.
+    """
+    spans = []
+    code = line
+    for k, ch in enumerate(line):
+        if ch == '/' or ch == ';':
+            code = line[:k]
+            spans.append((k, len(line) - k, "comment", ""))
+            break
+    tokens = []
+    for m in re.finditer(r"[^\s,]+", code):
+        token = m.group()
+        if token.endswith(':'):
+            spans.append((m.start(), len(token), "label", ""))
+        elif ':' not in token:
+            tokens.append((m.start(), token))
+    if not tokens:
+        return tuple(spans)
 
-def assembleCode(input_text):
-   # This is the assembler which i was using
-    inputline = []
-    machinecode = []
-    errorContainer = []
-    label = {}
+    # Colour the tokens by their shape; checkLine() decides what is wrong.
+    parts = [tokens[0]]
+    start, op = tokens[0]
+    op = op.lower()
+    if op in mnemonic or op in pseudo:
+        spans.append((start, len(op), "mnemonic", ""))
+        kinds = pseudo[op] if op in pseudo else operands[mnemonic[op][0]]
+    else:
+        kinds = ()
+    for (s, t), kind in zip(tokens[1:], kinds):
+        parts.append((s, t))
+        if kind == "mem" and '[' in t and ']' in t:
+            lb = t.find('[')
+            rb = t.find(']')
+            parts += [(s, t[:lb]), (s + lb + 1, t[lb + 1:rb])]
+            spans.append((s, lb, "number", ""))
+            if t[lb + 1:rb].lower() in reg:
+                spans.append((s + lb + 1, rb - lb - 1, "register", ""))
+        elif t.lower() in reg:
+            spans.append((s, len(t), "register", ""))
+        elif kind == "label" and t[:2].lower() != "0x":
+            spans.append((s, len(t), "ref", ""))
+        elif kind != "reg":
+            spans.append((s, len(t), "number", ""))
 
-    def logError(msg):
-        errorContainer.append(msg)
-    lines = input_text.splitlines()
-    for line in lines:
-        inputline.append(line)
-    for i in range(len(inputline)):
-        inputline[i] = parser(inputline[i])
-    for i in range(len(inputline)):
-        tokens = inputline[i].split()
-        for token in tokens:
-            if token.endswith(':'):
-                label[token[:-1]] = i + 1
-    for i in range(len(inputline)):
-        tokens = []
-        for token in inputline[i].split():
-            if ':' not in token:
-                tokens.append(token)
-            elif token.endswith(':'):
-                label[token[:-1]] = i + 1
-        if not tokens:
-            continue
-        op = tokens[0].lower()
-        if op in opcodes:
-            base_op = op
-        elif op.endswith('u') and op[:-1] in opcodes:
-            base_op = op[:-1]
-        elif op.endswith('h') and op[:-1] in opcodes:
-            base_op = op[:-1]
-        else:
-            logError("Unknown opcode: " + op)
-            continue
-        opp = opcodes[base_op]
-        if op not in instrType:
-            logError("Unknown instruction type for: " + op)
-            continue
-        type_val = instrType[op]
-        ans = ""
+    errors = []
+    end = tokens[-1][0] + len(tokens[-1][1])
+    for msg in checkLine(line):
+        named = msg.rsplit(None, 1)[-1].lower()
+        at = (start, end - start)
+        for s, t in parts:
+            if t and t.lower() == named:
+                at = (s, len(t))
+                break
+        errors.append(at + ("error", msg))
+    return tuple(spans + errors)
 
-        if type_val == 0:
-            ans += opp
-            ans = ans.ljust(32, '0')
-            machinecode.append(ans)
-        elif type_val == 1:
-            ans += opp
-            op1 = tokens[1]
-            g = False
-            if op1.startswith("0") and len(op1) > 1 and op1[1] in "xX":
-                try:
-                    label[op1] = hti(op1)
-                    g = True
-                except Exception:
-                    logError("Invalid hex operand: " + op1)
-                    continue
-            if op1 not in label:
-                logError("Undefined label: " + op1)
-                continue
-            y = -i + label[op1]
-            off = tc(y)
-            if g:
-                off = tc(label[op1])
-            ans += off
-            machinecode.append(ans)
-        elif type_val == 2:
-            if len(tokens) < 3:
-                logError("Error: Not enough operands for " + op)
-                continue
-            op1 = tokens[1]
-            op2 = tokens[2]
-            if op1 not in reg:
-                logError("Unknown register: " + op1)
-                continue
-            if op2[0].lower() == 'r':
-                ans += opp + "0" + reg[op1] + "0000" + reg.get(op2.lower(), "")
-                ans = ans.ljust(32, '0')
-                machinecode.append(ans)
-            else:
-                mod = "00"
-                if len(op) == len(base_op) + 1:
-                    mod = "01" if op[-1] == 'u' else "10"
-                    opp = opcodes[base_op]
-                else:
-                    opp = tokens[0]
-                ans += opp
-                ans += "1" + reg[op1] + "0000"
-                u = en(op2)
-                if u == "":
-                    logError("Error: No numeric part found in operand: " + op2)
-                    continue
-                try:
-                    k = int(u, 0)
-                except Exception:
-                    logError("Invalid numeric operand: " + op2)
-                    continue
-                imm = inb(k, 16)
-                ans += mod + imm
-                machinecode.append(ans)
-        elif type_val == 3:
-            if len(tokens) < 4:
-                logError("Error: Not enough operands for " + op)
-                continue
-            op1 = tokens[1]
-            op2 = tokens[2]
-            op3 = tokens[3]
-            if op1 not in reg:
-                logError("Unknown register: " + op1)
-                continue
-            if op3[0].lower() == 'r':
-                if op3.lower() not in reg:
-                    logError("Unknown register: " + op3)
-                    continue
-                opp2 = opcodes[op] if op in opcodes else opcodes[base_op]
-                ans += opp2 + "0" + reg[op1] + reg[op2] + reg[op3.lower()]
-                ans = ans.ljust(32, '0')
-                machinecode.append(ans)
+class AsmHighlighter(QSyntaxHighlighter):
+    """
+    Syntax highlighter for the input editor.
+    Qt only calls highlightBlock() for blocks whose text changed, and
+    lexLine() is cached, so typing stays cheap on very large files.
+    Errors are drawn with a wavy underline on top of the token colour.
+    """
+    def __init__(self, document):
+        super().__init__(document)
+        self.formats = {}
+        for kind, color, bold in (("mnemonic", "#0d47a1", True), ("register", "#6a1b9a", False),
+                                  ("number", "#e65100", False), ("label", "#2e7d32", True),
+                                  ("ref", "#2e7d32", False), ("comment", "#757575", False)):
+            fmt = QTextCharFormat()
+            fmt.setForeground(QColor(color))
+            if bold:
+                fmt.setFontWeight(QFont.Bold)
+            self.formats[kind] = fmt
+
+    def highlightBlock(self, text):
+        for start, length, kind, msg in lexLine(text):
+            if kind == "error":
+                fmt = QTextCharFormat(self.format(start))
+                fmt.setUnderlineStyle(QTextCharFormat.SpellCheckUnderline)
+                fmt.setUnderlineColor(QColor("#d32f2f"))
             else:
-                mod = "00"
-                if len(op) == len(base_op) + 1:
-                    mod = "01" if op[-1] == 'u' else "10"
-                    opp2 = opcodes[base_op]
-                else:
-                    opp2 = op
-                ans += opp2 + "1" + reg[op1] + reg[op2]
-                u = en(op3)
-                if u == "":
-                    logError("Error: No numeric part found in operand: " + op3)
-                    continue
-                try:
-                    k = int(u, 0)
-                except Exception:
-                    logError("Invalid numeric operand: " + op3)
-                    continue
-                imm = inb(k, 16)
-                ans += mod + imm
-                machinecode.append(ans)
-        elif type_val == 4:
-            if len(tokens) < 3:
-                logError("Error: Not enough operands for " + op)
-                continue
-            rd = tokens[1]
-            imv = tokens[2]
-            lb = imv.find('[')
-            rb = imv.find(']')
-            if lb == -1 or rb == -1:
-                logError("Error: Memory operand format error in: " + inputline[i])
-                continue
-            imm = imv[:lb]
-            rs1 = imv[lb+1:rb]
-            if rd not in reg or rs1 not in reg:
-                logError("Unknown register in memory operand: " + inputline[i])
-                continue
-            num = en(imm)
-            if num == "":
-                logError("Error: No numeric part found in immediate operand: " + imm)
-                continue
-            try:
-                immv = int(num, 0)
-            except Exception:
-                logError("Invalid immediate operand: " + imm)
-                continue
-            imb = inb(immv, 4)
-            roi = "1"
-            ans = opcodes[op] + roi + reg[rd] + reg[rs1]
-            ans += "0" * 14
-            ans += imb
-            machinecode.append(ans)
-    hexCode = []
-    try:
-        # Write to a default hex file (this can be bypassed with the Output File button)
-        with open("hexfile.hex", "w") as f:
-            for mc in machinecode:
-                value = int(mc, 2)
-                hexValue = format(value, 'X').upper().zfill(8)
-                f.write(hexValue + "\n")
-                hexCode.append(hexValue)
-    except Exception:
-        errorContainer.append("Error: Could not create hexfile.hex!")
-    
-    return {"binaryCode": machinecode, "hexCode": hexCode, "errors": errorContainer}
+                fmt = self.formats[kind]
+            self.setFormat(start, length, fmt)
 
 class AssemblerGUI(QWidget):
     def __init__(self):
@@ -265,6 +138,8 @@ class AssemblerGUI(QWidget):
         # Create text edit widgets with individual styles
         self.inputEdit = QPlainTextEdit(self)
         self.inputEdit.setStyleSheet("background-color: #fff9c4; color: #000; font-family: monospace;")
+        self.highlighter = AsmHighlighter(self.inputEdit.document())
+        self.inputEdit.viewport().installEventFilter(self)
         self.binaryEdit = QPlainTextEdit(self)
         self.binaryEdit.setStyleSheet("background-color: #c8e6c9; color: #000; font-family: monospace;")
         self.hexEdit = QPlainTextEdit(self)
@@ -348,6 +223,20 @@ class AssemblerGUI(QWidget):
         self.setWindowTitle("Assembler GUI")
         self.resize(900, 650)
     
+    def eventFilter(self, obj, event):
+        # Show the diagnostics of the hovered token as a tooltip.
+        if obj is self.inputEdit.viewport() and event.type() == QEvent.ToolTip:
+            cursor = self.inputEdit.cursorForPosition(event.pos())
+            col = cursor.positionInBlock()
+            msgs = [msg for start, length, kind, msg in lexLine(cursor.block().text())
+                    if kind == "error" and start <= col <= start + length]
+            if msgs:
+                QToolTip.showText(event.globalPos(), "\n".join(msgs), obj)
+            else:
+                QToolTip.hideText()
+            return True
+        return super().eventFilter(obj, event)
+
     def onLoadClicked(self):
         # Open a file dialog to select an assembly file to load
         filename, _ = QFileDialog.getOpenFileName(self, "Open Assembly File", "",
@@ -373,7 +262,7 @@ class AssemblerGUI(QWidget):
     
     def onDebugClicked(self):
         inputCode = self.inputEdit.toPlainText()
-        result = assembleCode(inputCode)
+        result = assembleCode(inputCode, write=False)
         self.debugEdit.clear()
         if not result["errors"]:
             self.debugEdit.appendPlainText("No errors found.")
@@ -387,7 +276,7 @@ class AssemblerGUI(QWidget):
     def onOutputClicked(self):
         # Assemble the code and then prompt the user to save the hex output
         inputCode = self.inputEdit.toPlainText()
-        result = assembleCode(inputCode)
+        result = assembleCode(inputCode, write=False)
         if result["errors"]:
             self.debugEdit.appendPlainText("Assembly errors: " + "; ".join(result["errors"]))
             return
@@ -395,10 +284,10 @@ class AssemblerGUI(QWidget):
                                                   "Hex Files (*.hex *.txt);;All Files (*)")
         if filename:
             try:
-                with open(filename, "w") as f:
-                    for hex_line in result["hexCode"]:
-                        f.write(hex_line + "\n")
-                self.debugEdit.appendPlainText("Hex output saved to " + filename)
+                if writeHex(filename, result["words"]):
+                    self.debugEdit.appendPlainText("Hex output saved to " + filename)
+                else:
+                    self.debugEdit.appendPlainText(filename + " is already up to date")
             except Exception as e:
                 self.debugEdit.appendPlainText("Error saving file: " + str(e))
 
@@ -0,0 +1,141 @@
+import marshal
+import os
+import sys
+
+# Declarative description of the instruction set.
+# Everything the engines need (encode tables, decode tables, mnemonic
+# lookup) is compiled from these tables by load().
+
+# Bit fields of a 32 bit word: name -> (lowest bit, width).
+FIELDS = {
+    "opcode": (27, 5),
+    "i": (26, 1),        # 1 when the last operand is an immediate.
+    "rd": (22, 4),
+    "rs1": (18, 4),
+    "rs2": (14, 4),
+    "mod": (16, 2),
+    "imm": (0, 16),
+    "offset": (0, 27),   # Branch offset, two's complement.
+    "memimm": (0, 4)     # Load/store offset.
+}
+
+# Field layout of each instruction type. Alternatives are split by '|':
+# the register form comes first, the immediate form (i = 1) second.
+FORMATS = {
+    0: ("opcode",),
+    1: ("opcode", "offset"),
+    2: ("opcode", "i", "rd", "rs2|mod imm"),
+    3: ("opcode", "i", "rd", "rs1", "rs2|mod imm"),
+    4: ("opcode", "i", "rd", "rs1", "memimm")
+}
+
+# Mnemonic suffixes and the value they put in the modifier field.
+MODIFIERS = {"": 0, "u": 1, "h": 2}
+
+# Number of general purpose registers, named r0 upwards.
+REGISTERS = 15
+
+# mnemonic, opcode, type, operand kinds, allowed modifier suffixes.
+# Operand kinds: "reg", "imm", "reg|imm", "label", "mem" (imm[reg]).
+INSTRUCTIONS = (
+    ("add", 0b00000, 3, ("reg", "reg", "reg|imm"), "uh"),
+    ("sub", 0b00001, 3, ("reg", "reg", "reg|imm"), "uh"),
+    ("mul", 0b00010, 3, ("reg", "reg", "reg|imm"), "uh"),
+    ("div", 0b00011, 3, ("reg", "reg", "reg|imm"), "uh"),
+    ("mod", 0b00100, 3, ("reg", "reg", "reg|imm"), "uh"),
+    ("cmp", 0b00101, 2, ("reg", "reg|imm"), ""),
+    ("and", 0b00110, 3, ("reg", "reg", "reg|imm"), "uh"),
+    ("or", 0b00111, 3, ("reg", "reg", "reg|imm"), "uh"),
+    ("not", 0b01000, 2, ("reg", "reg|imm"), "uh"),
+    ("mov", 0b01001, 2, ("reg", "reg|imm"), "uh"),
+    ("lsl", 0b01010, 3, ("reg", "reg", "reg|imm"), "uh"),
+    ("lsr", 0b01011, 3, ("reg", "reg", "reg|imm"), "uh"),
+    ("asr", 0b01100, 3, ("reg", "reg", "reg|imm"), "uh"),
+    ("nop", 0b01101, 0, (), ""),
+    ("ld", 0b01110, 4, ("reg", "mem"), ""),
+    ("st", 0b01111, 4, ("reg", "mem"), ""),
+    ("beq", 0b10000, 1, ("label",), ""),
+    ("bgt", 0b10001, 1, ("label",), ""),
+    ("b", 0b10010, 1, ("label",), ""),
+    ("call", 0b10011, 1, ("label",), ""),
+    ("ret", 0b10100, 0, (), ""),
+    ("hlt", 0b11111, 0, (), "")
+)
+
+# Pseudo-instructions the assemblers expand into real ones, with their
+# operand kinds (see expandPseudo() in Assembler.py).
+PSEUDO = (
+    ("li", ("reg", "imm")),
+)
+
+_isa = None
+
+def compileISA():
+    """
+    Build the lookup tables from the declarative description.
+    The result only holds dicts, tuples, strings and ints so it can be
+    stored with marshal.
+    """
+    width = FIELDS["opcode"][1]
+    regWidth = FIELDS["rd"][1]
+    t = {
+        "opcodes": {}, "instrType": {}, "mnemonic": {}, "operands": {}, "decode": {},
+        "pseudo": dict(PSEUDO), "reg": {}, "regNum": {},
+        "fields": dict(FIELDS), "mask": {}, "layout": {},
+        "wordMask": (1 << (FIELDS["opcode"][0] + width)) - 1
+    }
+    for name in FIELDS:
+        t["mask"][name] = (1 << FIELDS[name][1]) - 1
+    # Fields set for each type, in register form (i = 0) and immediate form (i = 1).
+    for type_val in FORMATS:
+        forms = ([], [])
+        for part in FORMATS[type_val]:
+            alt = part.split("|")
+            forms[0].extend(alt[0].split())
+            forms[1].extend(alt[-1].split())
+        t["layout"][type_val] = (tuple(forms[0]), tuple(forms[1]))
+    for name, code, type_val, operands, suffixes in INSTRUCTIONS:
+        t["opcodes"][name] = format(code, "0{}b".format(width))
+        t["operands"][name] = operands
+        t["decode"][code] = (name, type_val)
+        for suffix in ("",) + tuple(suffixes):
+            t["instrType"][name + suffix] = type_val
+            t["mnemonic"][name + suffix] = (name, code, type_val, MODIFIERS[suffix])
+    for n in range(REGISTERS):
+        t["reg"]["r" + str(n)] = format(n, "0{}b".format(regWidth))
+        t["regNum"]["r" + str(n)] = n
+    return t
+
+def load():
+    """
+    Return the compiled ISA tables.
+    They are compiled on first use and kept in __pycache__/isa.marshal
+    together with a key made of this module's size and modification time
+    and the Python and marshal versions, so later runs only read the file
+    back and any change recompiles it in place.
+    """
+    global _isa
+    if _isa is not None:
+        return _isa
+    here = os.path.abspath(__file__)
+    st = os.stat(here)
+    key = (st.st_size, st.st_mtime_ns, sys.implementation.cache_tag, marshal.version)
+    cache = os.path.join(os.path.dirname(here), "__pycache__", "isa.marshal")
+    try:
+        with open(cache, "rb") as f:
+            stored, tables = marshal.load(f)
+        if stored == key:
+            _isa = tables
+            return _isa
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    _isa = compileISA()
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmp = cache + ".%d.tmp" % os.getpid()
+        with open(tmp, "wb") as f:
+            marshal.dump((key, _isa), f)
+        os.replace(tmp, cache)
+    except OSError:
+        pass
+    return _isa